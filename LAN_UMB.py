@@ -3,10 +3,96 @@
 import time
 import struct
 import socket
+import functools
+
+# Numba is optional; without it the pure Python table code is used
+try:
+    import numpy as np
+    from numba import njit, types
+except ImportError:
+    njit = None
 
 class UMBError(BaseException):
     pass
 
+# Lookup table for the UMB checksum (CRC16, reflected polynomial 0x8408).
+# Entry i holds the CRC contribution of one byte value i, so the
+# checksum can be updated byte-wise instead of bit-wise.
+def _build_crc16_table():
+    table = []
+    for i in range(256):
+        crc_buff = i
+        for bit in range(8):
+            x16 = 0x8408 & -(crc_buff & 0x0001)
+            crc_buff = (crc_buff >> 1) ^ x16
+        table.append(crc_buff)
+    return table
+
+_CRC16_TABLE = tuple(_build_crc16_table())
+
+if njit is not None:
+    # np.frombuffer() on bytes gives a read-only array
+    @njit(types.uint16(types.Array(types.uint8, 1, 'C', readonly=True)), cache=True, boundscheck=False)
+    def _crc16_nb(data):
+        crc = 0xFFFF
+        for b in data:
+            crc ^= b
+            for _ in range(8):
+                crc = (crc >> 1) ^ (0x8408 & -(crc & 1))
+        return crc
+else:
+    _crc16_nb = None
+
+# Precompiled unpackers for the UMB data types
+_TYPE_UNPACKER = {
+    16: struct.Struct('<B').unpack_from,    # UNSIGNED_CHAR
+    17: struct.Struct('<b').unpack_from,    # SIGNED_CHAR
+    18: struct.Struct('<H').unpack_from,    # UNSIGNED_SHORT
+    19: struct.Struct('<h').unpack_from,    # SIGNED_SHORT
+    20: struct.Struct('<L').unpack_from,    # UNSIGNED_LONG
+    21: struct.Struct('<l').unpack_from,    # SIGNED_LONG
+    22: struct.Struct('<f').unpack_from,    # FLOAT
+    23: struct.Struct('<d').unpack_from,    # DOUBLE
+}
+
+# Payload of a multi channel request; the channel list usually
+# stays the same from one query to the next. The cache is keyed by
+# the channels as given (str or int), so a hit also skips int().
+@functools.lru_cache(maxsize=32)
+def _encode_chlist(chtuple):
+    return struct.pack('<B%dH' % len(chtuple), len(chtuple), *map(int, chtuple))
+
+# Status messages of the UMB protocol
+_STATUS_MESSAGES = {
+    0: "Command successful; no error; all OK",
+    16: "Unknown command; not supported by this device",
+    17: "Invalid parameter",
+    18: "Invalid header version",
+    19: "Invalid version of the command",
+    20: "Invalid password for command",
+    32: "Read error",
+    33: "Write error",
+    34: "Length too great; max. permissible length is designated in <maxlength>",
+    35: "Invalid address / storage location",
+    36: "Invalid channel",
+    37: "Command not possible in this mode",
+    38: "Unknown calibration command",
+    39: "Calibration error",
+    40: "Device not ready; e.g. initialisation / calibration running",
+    41: "Undervoltage",
+    42: "Hardware error",
+    43: "Measurement error",
+    44: "Error on device initialization",
+    45: "Error in operating system",
+    48: "Configuration error, default configuration was loaded",
+    49: "Calibration error / the calibration is invalid, measurement not possible",
+    50: "CRC error on loading configuration; default configuration was loaded",
+    51: "CRC error on loading calibration; measurement not possible",
+    52: "Calibration step 1",
+    53: "Calibrations OK",
+    54: "Channel deactivated",
+}
+
 class LAN_UMB:
     """
     This is a simple driver for communicating to Weatherstations
@@ -52,6 +138,19 @@ class LAN_UMB:
         ./LAN_UMB.py 100 111 200 300 460 580
     """
 
+    # Frame fields that do not change between requests
+    _SOH, _STX, _ETX, _EOT = b'\x01', b'\x02', b'\x03', b'\x04'
+    _VERSION = b'\x10'
+    _TO_CLASS = b'\x70'
+    _FROM = b'\x01'
+    _FROM_CLASS = b'\xF0'
+    # SOH, VERSION, TO, TO_CLASS, FROM, FROM_CLASS, LEN, STX, COMMAND, COMMAND_VERSION
+    _HEADER = struct.Struct('<ccBcccBcBB')
+    # CRC and EOT, appended to every transmit-frame
+    _TRAILER = struct.Struct('<Hc')
+    # Complete frame of an online data request (cmd 0x23): header, channel, ETX
+    _FRAME_0x23 = struct.Struct(_HEADER.format + 'Hc')
+
     def __init__(self, ip, port=52015):
         self.ip = ip
         self.port = port
@@ -59,81 +158,98 @@ class LAN_UMB:
     def __enter__(self): # throws a SerialException if it cannot connect to device
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.connect((self.ip, self.port))
+        # Requests are tiny and answered synchronously; do not let
+        # Nagle's algorithm hold them back
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         return self
     
     def __exit__(self, exception_type, exception_value, traceback):
         self.s.close()
             
-    # The devices do not send <CR><LF>, thus the receive command
-    # will only return after timeout. In order to cope with longer
-    # delays up the 10 receive commands are issued as long as there
-    # data.
-    def readFromLAN(self, timeout=0.1):
+    # The devices do not send <CR><LF>, so the frame length is taken
+    # from the LEN field at offset 6: a frame has 12 + LEN bytes.
+    # Receive exactly that many bytes; on timeout, return what has
+    # arrived so far.
+    def readFromLAN(self, timeout=1):
         self.s.settimeout(timeout)
-        data = b''
+        data = bytearray()
         
-        loops = 0
-        while loops < 10:
-            try:
-                new_data = self.s.recv(1024)
-                data = data + new_data
-            except socket.timeout:
-                if len(data) < 12:
-                    loops = loops +1
-                else:
-                    loops = 1000
+        size = 7
+        try:
+            while len(data) < size:
+                new_data = self.s.recv(size - len(data))
+                if not new_data:
+                    break
+                data.extend(new_data)
+                if size == 7 and len(data) == 7:
+                    size = 12 + data[6]
+        except socket.timeout:
+            pass
                 
-        return data
+        return bytes(data)
+    
+    # A reply that arrived after readFromLAN gave up is still in the
+    # socket; discard it, otherwise it would be taken as the answer
+    # to the next request. A late reply that only arrives after this
+    # drain, i.e. between send and readFromLAN, is still mistaken for
+    # the answer to the current request.
+    def _drop_old_data(self):
+        self.s.setblocking(False)
+        dropped = 0
+        try:
+            while True:
+                new_data = self.s.recv(1024)
+                if not new_data:
+                    break
+                dropped += len(new_data)
+        except BlockingIOError:
+            pass
+        finally:
+            self.s.setblocking(True)
+        if dropped > 0:
+            print("Drop old data")
     
     def calc_next_crc_byte(self, crc_buff, nextbyte):
-        for i in range (8):
-            if( (crc_buff & 0x0001) ^ (nextbyte & 0x01) ):
-                x16 = 0x8408;
-            else:
-                x16 = 0x0000;
-            crc_buff = crc_buff >> 1;
-            crc_buff ^= x16;
-            nextbyte = nextbyte >> 1;
-        return(crc_buff);
+        return (crc_buff >> 8) ^ _CRC16_TABLE[(crc_buff ^ nextbyte) & 0xFF]
     
-    def calc_crc16(self, data):
-        crc = 0xFFFF;
+    @staticmethod
+    def calc_crc16(data):
+        if _crc16_nb is not None:
+            return int(_crc16_nb(np.frombuffer(data, dtype=np.uint8)))
+        crc = 0xFFFF
+        table = _CRC16_TABLE
         for byte in data:
-            crc = self.calc_next_crc_byte(crc, byte);
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
         return crc
     
     # Handle communication with the device
     # Returns payload of the answer; use the specific functions
     # `parse_<cmd>` to interprete the response
-    def send_request(self, receiver_id, command, command_version, payload=''):
-        
-        SOH, STX, ETX, EOT= b'\x01', b'\x02', b'\x03', b'\x04'
-        VERSION = b'\x10'
-        TO = int(receiver_id).to_bytes(1,'little')
-        TO_CLASS = b'\x70'
-        FROM = int(1).to_bytes(1,'little')
-        FROM_CLASS = b'\xF0'
+    def send_request(self, receiver_id, command, command_version, payload=b''):
         
-        LEN = 2
-        for payload_byte in payload:
-            LEN += 1
-        LEN = int(LEN).to_bytes(1,'little')
+        LEN = 2 + len(payload)
         
+        # Assemble transmit-frame
+        header = self._HEADER.pack(self._SOH, self._VERSION, int(receiver_id), self._TO_CLASS, self._FROM, self._FROM_CLASS, LEN, self._STX, int(command), int(command_version))
+        tx_frame = header + bytes(payload) + self._ETX
+        return(self._exchange(tx_frame, command, command_version))
+    
+    # Send an assembled transmit-frame (without checksum and EOT)
+    # and return the payload of the answer
+    def _exchange(self, tx_frame, command, command_version):
         
-        COMMAND = int(command).to_bytes(1,'little')
-        COMMAND_VERSION = int(command_version).to_bytes(1,'little')
+        SOH, STX, ETX = self._SOH[0], self._STX[0], self._ETX[0]
+        VERSION = self._VERSION[0]
         
-        # Assemble transmit-frame
-        if len(payload) > 0:
-            tx_frame = SOH + VERSION + TO + TO_CLASS + FROM + FROM_CLASS + LEN + STX + COMMAND + COMMAND_VERSION + payload + ETX
-        else:
-            tx_frame = SOH + VERSION + TO + TO_CLASS + FROM + FROM_CLASS + LEN + STX + COMMAND + COMMAND_VERSION + ETX
+        COMMAND = int(command)
+        COMMAND_VERSION = int(command_version)
 
         # calculate checksum for transmit-frame and concatenate
-        tx_frame += self.calc_crc16(tx_frame).to_bytes(2, 'little') + EOT
+        tx_frame += self._TRAILER.pack(self.calc_crc16(tx_frame), self._EOT)
         
         # Write transmit-frame to serial
+        self._drop_old_data()
         self.s.send(tx_frame)
         #print([hex(c) for c in tx_frame])
         
@@ -148,84 +264,78 @@ class LAN_UMB:
             return(0)
         
         # Check the length of the frame
-        length = int.from_bytes(rx_frame[6:7], byteorder='little')
-        if (rx_frame[8+length:9+length] != ETX):
+        length = rx_frame[6] if len(rx_frame) > 6 else 0
+        if (len(rx_frame) < length + 12 or rx_frame[8+length] != ETX):
             raise UMBError("RX-Error! Length of Payload is not valid. length-field says: " + str(length))
             
-        # Drop data that has arievd too late
-        if (len(rx_frame) > length + 12):
-            print("Drop old data")
-            rx_frame = rx_frame[length+12:]
+        # Validate on a view, so that sub-frames are not copied
+        mv = memoryview(rx_frame)
      
         # compare checksum field to calculated checksum
-        cs_calculated = self.calc_crc16(rx_frame[:-3]).to_bytes(2, 'little')
-        cs_received = rx_frame[-3:-1]
+        cs_calculated = self.calc_crc16(mv[:-3])
+        cs_received = mv[-3] | (mv[-2] << 8)
         if (cs_calculated != cs_received):
-            raise UMBError("RX-Error! Checksum test failed. Calculated Checksum: " + str(cs_calculated) + "| Received Checksum: " + str(cs_received))
+            raise UMBError("RX-Error! Checksum test failed. Calculated Checksum: " + hex(cs_calculated) + "| Received Checksum: " + hex(cs_received))
      
         # Check if all frame field are valid
-        if (rx_frame[0:1] != SOH):
+        if (mv[0] != SOH):
             raise UMBError("RX-Error! No Start-of-frame Character")
-        if (rx_frame[1:2] != VERSION):
+        if (mv[1] != VERSION):
             raise UMBError("RX-Error! Wrong Version Number")
-        #if (rx_frame[2:4] != (FROM + FROM_CLASS)):
+        #if (mv[2:4] != (FROM + FROM_CLASS)):
         #    raise UMBError("RX-Error! Wrong Destination ID")
-        #if (rx_frame[4:6] != (TO + TO_CLASS)):
+        #if (mv[4:6] != (TO + TO_CLASS)):
         #    raise UMBError("RX-Error! Wrong Source ID")
-        if (rx_frame[7:8] != STX):
+        if (mv[7] != STX):
             raise UMBError("RX-Error! Missing STX field")
-        if (rx_frame[8:9] != COMMAND):
+        if (mv[8] != COMMAND):
             raise UMBError("RX-Error! Wrong Command Number")
-        if (rx_frame[9:10] != COMMAND_VERSION):
+        if (mv[9] != COMMAND_VERSION):
             raise UMBError("RX-Error! Wrong Command Version Number")
          
         #
         # Todo: The pay load needs to be handled depending on the command
         #
-        payload = rx_frame[10:8+length]
+        payload = bytes(mv[10:8+length])
         return(payload)
 
     # Commands to parse 
 
     # cmd 0x23 and 0x2F
     def parse_data_request(self, payload):
+        return (self._parse_value(payload, 0))
+    
+    # Parse one value record starting at `offset` in the buffer
+    def _parse_value(self, payload, offset):
                 
-        type_of_value = int.from_bytes(payload[3:4], byteorder='little')
-        value = 0
-        
-        if type_of_value == 16:     # UNSIGNED_CHAR
-            value = struct.unpack('<B', payload[4:5])[0]
-        elif type_of_value == 17:   # SIGNED_CHAR
-            value = struct.unpack('<b', payload[4:5])[0]
-        elif type_of_value == 18:   # UNSIGNED_SHORT
-            value = struct.unpack('<H', payload[4:6])[0]
-        elif type_of_value == 19:   # SIGNED_SHORT
-            value = struct.unpack('<h', payload[4:6])[0]
-        elif type_of_value == 20:   # UNSIGNED_LONG
-            value = struct.unpack('<L', payload[4:8])[0]
-        elif type_of_value == 21:   # SIGNED_LONG
-            value = struct.unpack('<l', payload[4:8])[0]
-        elif type_of_value == 22:   # FLOAT
-            value = struct.unpack('<f', payload[4:8])[0]
-        elif type_of_value == 23:   # DOUBLE
-            value = struct.unpack('<d', payload[4:12])[0]
-        
-        return (value)
+        # Records without type byte carry no value (e.g. status only)
+        if len(payload) <= offset+3:
+            return (0)
+        type_of_value = payload[offset+3]
+        unpack_from = _TYPE_UNPACKER.get(type_of_value)
+        if unpack_from is None:
+            return (0)
+        return (unpack_from(payload, offset+4)[0])
     
     # cmd 0x2F
     def parse_multi_channel_request(self, payload):
     
-        n = int.from_bytes(payload[1:2], byteorder='little')
+        n = payload[1]
         #print("Number of values %d" % n)
         
         ptr = 2
         valist = []
+        append = valist.append
+        parse_value = self._parse_value
         for i in range(0,n):
-            nsub = int.from_bytes(payload[ptr:ptr+1], byteorder='little')
+            nsub = payload[ptr]
             #print("Sub length %d" % nsub)
             
-            value = self.parse_data_request(payload[ptr+1:ptr+nsub+2])
-            valist.append(value)
+            # status and channel only, no type byte
+            if nsub < 4:
+                append(0)
+            else:
+                append(parse_value(payload, ptr+1))
             ptr = ptr + nsub + 1
         
         return (valist)
@@ -233,68 +343,14 @@ class LAN_UMB:
     # cmd 0x26
     def parse_status_request(self, payload):
 
-        status = int.from_bytes(payload[1:2], byteorder='little')
+        status = payload[1]
         return(status)
 
     def checkStatus(self, status):
         #
         # Todo: add the calling function here
         #
-    
-        if status == 0:
-            return ("Command successful; no error; all OK")
-        elif status == 16:
-            return ("Unknown command; not supported by this device")
-        elif status == 17:
-            return ("Status: ungültige Parameter")
-        elif status == 18:
-            return ("Invalid parameter")
-        elif status == 19:
-            return ("Invalid version of the command")
-        elif status == 20:
-            return ("Invalid password for command")
-        elif status == 32:
-            return ("Read error")
-        elif status == 33:
-            return ("Write error")
-        elif status == 34:
-            return ("Length too great; max. permissible length is designated in <maxlength>")
-        elif status == 35:
-            return ("Invalid address / storage location")
-        elif status == 36:
-            return ("Invalid channel")
-        elif status == 37:
-            return ("Command not possible in this mode")
-        elif status == 38:
-            return ("Unknown calibration command")
-        elif status == 39:
-            return ("Calibration error")
-        elif status == 40:
-            return ("Device not ready; e.g. initialisation / calibration running")
-        elif status == 41:
-            return ("Undervoltage")
-        elif status == 42:
-            return ("Hardware error")
-        elif status == 43:
-            return ("Measurement error")
-        elif status == 44:
-            return ("Error on device initialization")
-        elif status == 45:
-            return ("Error in operating system")
-        elif status == 48:
-            return ("Configuration error, default configuration was loaded")
-        elif status == 49:
-            return ("Calibration error / the calibration is invalid, measurement not possible")
-        elif status == 50:
-            return ("CRC error on loading configuration; default configuration was loaded")
-        elif status == 51:
-            return ("CRC error on loading calibration; measurement not possible")
-        elif status == 52:
-            return ("Calibration step 1")
-        elif status == 53:
-            return ("Calibrations OK")
-        elif status == 54:
-            return ("Channel deactivated")
+        return (_STATUS_MESSAGES.get(status, "Unknown"))
   
     # cmd 0x28
     def parse_readout_time_request(self, payload):
@@ -314,16 +370,17 @@ class LAN_UMB:
     def onlineDataQuery(self, channel, receiver_id=1):
         
         value = 0
-        payload = self.send_request(receiver_id, 0x23, 0x10, int(channel).to_bytes(2,'little'))
+        command, command_version = 0x23, 0x10
+        # LEN: command and version (2) + channel (2)
+        tx_frame = self._FRAME_0x23.pack(self._SOH, self._VERSION, int(receiver_id), self._TO_CLASS, self._FROM, self._FROM_CLASS, 2 + 2, self._STX, command, command_version, int(channel), self._ETX)
+        payload = self._exchange(tx_frame, command, command_version)
         if (payload != 0):
             value = self.parse_data_request(payload)
         return(value)
     
     def onlineMultiChannelQuery(self, chlist, receiver_id=1):
         
-        chbyteseq = len(chlist).to_bytes(1,'little')
-        for channel in chlist:
-            chbyteseq = chbyteseq + int(channel).to_bytes(2,'little')
+        chbyteseq = _encode_chlist(tuple(chlist))
         
         valist = []
         payload = self.send_request(receiver_id, 0x2F, 0x10, chbyteseq)
@@ -370,6 +427,7 @@ class LAN_UMB:
 
 import sys
 import json
+import operator
 from datetime import datetime
 import argparse
 
@@ -424,21 +482,15 @@ if __name__ == "__main__":
 
         with LAN_UMB(ip=args.ip) as umb:
 
+            chtuple = tuple(chlist)
             lastvalues = [0] * len(chlist)
             while(args.loop):
-                mydict = {}
 
                 # Read data
-                valist = umb.onlineMultiChannelQuery(chlist)
-                for channel,value in zip(chlist,valist):
-                    mydict[channel] = value
+                valist = umb.onlineMultiChannelQuery(chtuple)
 
                 # print values only, if they have changed
-                changed = 0
-                if len(valist) > 0:
-                    for last, value in zip(lastvalues, valist):
-                        if last != value:
-                            changed = changed + 1
+                changed = sum(map(operator.ne, lastvalues, valist))
                 if changed > 0:
                     print(datetime.now(), changed, valist)
                     lastvalues = valist
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import struct
+import unittest
+from unittest import mock
+
+import LAN_UMB
+from LAN_UMB import LAN_UMB as UMB
+
+
+# Bit-serial reference for the checksum, as given in the UMB
+# specification
+def crc16_reference(data):
+    crc_buff = 0xFFFF
+    for nextbyte in data:
+        for i in range(8):
+            if (crc_buff & 0x0001) ^ (nextbyte & 0x01):
+                x16 = 0x8408
+            else:
+                x16 = 0x0000
+            crc_buff = crc_buff >> 1
+            crc_buff ^= x16
+            nextbyte = nextbyte >> 1
+    return crc_buff
+
+
+class TestCRC16(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(UMB.calc_crc16(b''), 0xFFFF)
+
+    def test_online_data_request_frame(self):
+        # Request for channel 100, up to and including ETX
+        frame = bytes([0x01, 0x10, 0x01, 0x70, 0x01, 0xF0, 0x04, 0x02, 0x23, 0x10, 0x64, 0x00, 0x03])
+        self.assertEqual(UMB.calc_crc16(frame), 0xD961)
+        self.assertEqual(crc16_reference(frame), 0xD961)
+
+    def check_random_frames(self):
+        for size in (1, 7, 13, 40, 200, 267):
+            data = os.urandom(size)
+            expected = crc16_reference(data)
+            self.assertEqual(UMB.calc_crc16(data), expected)
+            self.assertEqual(UMB.calc_crc16(memoryview(data)), expected)
+
+    def test_next_crc_byte(self):
+        umb = UMB('127.0.0.1')
+        data = os.urandom(40)
+        crc = 0xFFFF
+        for byte in data:
+            crc = umb.calc_next_crc_byte(crc, byte)
+        self.assertEqual(crc, crc16_reference(data))
+
+    @unittest.skipIf(LAN_UMB._crc16_nb is None, 'Numba is not installed')
+    def test_numba(self):
+        self.check_random_frames()
+
+    def test_python_fallback(self):
+        with mock.patch.object(LAN_UMB, '_crc16_nb', None):
+            self.check_random_frames()
+
+
+class TestParse(unittest.TestCase):
+
+    def setUp(self):
+        self.umb = UMB('127.0.0.1')
+
+    def test_data_request(self):
+        payload = bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5)
+        self.assertEqual(self.umb.parse_data_request(payload), 1.5)
+
+    def test_data_request_without_type(self):
+        # status and channel only
+        self.assertEqual(self.umb.parse_data_request(bytes([0x24, 0x64, 0x00])), 0)
+
+    def test_multi_channel_request(self):
+        value = bytes([0x00, 0x64, 0x00, 17, 0xFD])
+        no_value = bytes([0x24, 0xC8, 0x00])
+        payload = bytes([0x00, 2, len(value)]) + value + bytes([len(no_value)]) + no_value
+        self.assertEqual(self.umb.parse_multi_channel_request(payload), [-3, 0])
+
+
+# Stands in for the device socket. `pending` is in the receive buffer
+# before the request, `chunks` are delivered one per recv after send().
+class FakeSocket:
+
+    def __init__(self, chunks, pending=b'', closed=False):
+        self.buffer = [pending] if pending else []
+        self.chunks = list(chunks)
+        self.closed = closed
+        self.blocking = True
+        self.sent = []
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, timeout):
+        self.blocking = True
+
+    def send(self, data):
+        self.sent.append(data)
+        self.buffer.extend(self.chunks)
+        self.chunks = []
+        return len(data)
+
+    def recv(self, n):
+        if not self.buffer:
+            if not self.blocking:
+                raise BlockingIOError()
+            if self.closed:
+                return b''
+            raise socket.timeout()
+        data = self.buffer.pop(0)
+        if len(data) > n:
+            self.buffer.insert(0, data[n:])
+        return data[:n]
+
+
+def reply(command, payload):
+    frame = bytes([0x01, 0x10, 0x01, 0xF0, 0x01, 0x70, 2 + len(payload), 0x02, command, 0x10]) + payload + b'\x03'
+    return frame + struct.pack('<H', UMB.calc_crc16(frame)) + b'\x04'
+
+
+class TestExchange(unittest.TestCase):
+
+    def query(self, sock):
+        umb = UMB('127.0.0.1')
+        umb.s = sock
+        return umb.onlineDataQuery(100)
+
+    def test_frame_split_across_recvs(self):
+        frame = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5))
+        self.assertEqual(self.query(FakeSocket([frame[:3], frame[3:9], frame[9:]])), 1.5)
+
+    def test_online_data_frame_matches_send_request(self):
+        frame = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5))
+        umb = UMB('127.0.0.1')
+        umb.s = FakeSocket([frame])
+        umb.onlineDataQuery(100)
+        umb.s.chunks = [frame]
+        umb.send_request(1, 0x23, 0x10, struct.pack('<H', 100))
+        self.assertEqual(umb.s.sent[0], umb.s.sent[1])
+
+    def test_reads_one_frame_only(self):
+        first = reply(0x26, bytes([0x00, 0x00]))
+        second = reply(0x26, bytes([0x00, 0x01]))
+        umb = UMB('127.0.0.1')
+        umb.s = FakeSocket([first + second])
+        umb.s.send(b'')
+        self.assertEqual(umb.readFromLAN(), first)
+
+    def test_nothing_received(self):
+        self.assertEqual(self.query(FakeSocket([])), 0)
+
+    def test_closed_mid_frame(self):
+        frame = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5))
+        with self.assertRaises(LAN_UMB.UMBError):
+            self.query(FakeSocket([frame[:9]], closed=True))
+
+    def test_timeout_after_header(self):
+        frame = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5))
+        with self.assertRaises(LAN_UMB.UMBError):
+            self.query(FakeSocket([frame[:7]]))
+
+    def test_multi_channel_query(self):
+        value = bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5)
+        frame = reply(0x2F, bytes([0x00, 1, len(value)]) + value)
+        for chlist in (['100'], (100,)):
+            umb = UMB('127.0.0.1')
+            umb.s = FakeSocket([frame])
+            self.assertEqual(umb.onlineMultiChannelQuery(chlist), [1.5])
+            self.assertEqual(umb.s.sent[0][10:13], bytes([1, 0x64, 0x00]))
+
+    def test_drop_late_reply(self):
+        late = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.0))
+        frame = reply(0x23, bytes([0x00, 0x64, 0x00, 22]) + struct.pack('<f', 1.5))
+        self.assertEqual(self.query(FakeSocket([frame], pending=late)), 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()